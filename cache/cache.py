@@ -0,0 +1,85 @@
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+import orjson
+import os
+
+# Caché compartido entre workers/réplicas. Sin REDIS_URL todo sigue yendo a la BD.
+REDIS_URL = os.getenv("REDIS_URL")
+LISTING_TTL = int(os.getenv("LISTING_CACHE_TTL", "30"))   # segundos
+PATH_TTL = int(os.getenv("PATH_CACHE_TTL", "86400"))      # segundos
+
+LISTING_KEY = "images:listing"   # hash: una página del listado por campo
+PATH_KEY = "images:path:{}"      # image_id → [category, filename, media_type]
+
+redis = Redis.from_url(REDIS_URL) if REDIS_URL else None
+
+
+# Si Redis falla, se degrada a "cache miss": nunca rompe un request.
+
+async def get_listing(page_key: str) -> bytes | None:
+    """Devuelve la página ya serializada en JSON, lista para responder."""
+    if redis is None:
+        return None
+    try:
+        return await redis.hget(LISTING_KEY, page_key)
+    except RedisError:
+        return None
+
+
+async def set_listing(page_key: str, payload: dict) -> bytes:
+    body = orjson.dumps(payload)
+    if redis is not None:
+        try:
+            async with redis.pipeline(transaction=False) as pipe:
+                pipe.hset(LISTING_KEY, page_key, body)
+                # NX (Redis >= 7): el TTL lo fija solo el primer llenado. Si cada
+                # llenado lo renovara, una página vieja escrita tras un DEL viviría
+                # mientras siga habiendo tráfico, no LISTING_TTL segundos.
+                pipe.expire(LISTING_KEY, LISTING_TTL, nx=True)
+                await pipe.execute()
+        except RedisError:
+            pass
+    return body
+
+
+async def invalidate_listing() -> None:
+    """Cualquier alta/cambio/baja invalida todas las páginas (un solo DEL)."""
+    if redis is None:
+        return
+    try:
+        await redis.delete(LISTING_KEY)
+    except RedisError:
+        pass
+
+
+async def get_path(image_id: int) -> tuple[str, str, str] | None:
+    if redis is None:
+        return None
+    try:
+        cached = await redis.get(PATH_KEY.format(image_id))
+    except RedisError:
+        return None
+    return tuple(orjson.loads(cached)) if cached else None
+
+
+async def set_path(image_id: int, entry: tuple[str, str, str]) -> None:
+    if redis is None:
+        return
+    try:
+        await redis.set(PATH_KEY.format(image_id), orjson.dumps(entry), ex=PATH_TTL)
+    except RedisError:
+        pass
+
+
+async def delete_path(image_id: int) -> None:
+    if redis is None:
+        return
+    try:
+        await redis.delete(PATH_KEY.format(image_id))
+    except RedisError:
+        pass
+
+
+async def close() -> None:
+    if redis is not None:
+        await redis.aclose()
\ No newline at end of file
@@ -1,5 +1,5 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import declarative_base
 import os
 
 # Siempre construir desde variables de entorno
@@ -13,22 +13,40 @@ DB_NAME = os.getenv("DB_NAME", "glossy_local")
 if not all([DB_USER, DB_PASSWORD, DB_HOST, DB_NAME]):
     raise ValueError("Faltan variables de entorno de base de datos requeridas")
 
-DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
-# ✅ Engine optimizado para PostgreSQL en producción
-engine = create_engine(
+# Workers de uvicorn por réplica (ver __main__ en main.py)
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "2"))
+# Conexiones que puede abrir cada réplica en total, repartidas entre sus workers.
+# × réplicas debe quedar por debajo de max_connections de Postgres (default 100).
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", "80"))
+_CONNECTIONS_PER_WORKER = max(2, DB_MAX_CONNECTIONS // WEB_CONCURRENCY)
+
+# ✅ Engine async (asyncpg) optimizado para PostgreSQL en producción
+engine = create_async_engine(
     DATABASE_URL,
-    # Pool de conexiones optimizado
-    pool_size=10,              # 10 conexiones permanentes
-    max_overflow=20,           # Hasta 20 conexiones adicionales bajo carga
-    pool_timeout=30,           # Timeout de 30 segundos para obtener conexión
-    pool_recycle=3600,         # Reciclar conexiones cada hora (evita "server closed connection")
-    pool_pre_ping=True,        # Verificar que la conexión esté viva antes de usarla
-    
+    # Pool de conexiones: con los defaults, 20 permanentes + 20 bajo carga por worker
+    pool_size=_CONNECTIONS_PER_WORKER // 2,
+    max_overflow=_CONNECTIONS_PER_WORKER - _CONNECTIONS_PER_WORKER // 2,
+    pool_timeout=5,            # Fallar rápido si el pool está agotado
+    pool_recycle=1800,         # Reciclar conexiones cada 30 min (evita "server closed connection")
+    pool_pre_ping=False,       # Sin SELECT 1 por checkout: lo cubren pool_recycle + keepalives
+    query_cache_size=1200,     # Caché de SQL compilado (default 500)
+    connect_args={
+        "prepared_statement_cache_size": 500,  # Statements preparados por conexión (asyncpg)
+        # asyncpg no expone los keepalives de libpq: se configuran del lado del servidor
+        "server_settings": {
+            "application_name": "glossy-api",
+            "tcp_keepalives_idle": "30",
+            "tcp_keepalives_interval": "10",
+            "tcp_keepalives_count": "3",
+        },
+    },
+
     # Opciones de ejecución
     echo=False,                # No loggear queries SQL (cambiar a True solo en dev)
-    future=True,               # Usar SQLAlchemy 2.0 style
 )
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# expire_on_commit=False: con AsyncSession no hay lazy-load implícito después del commit
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
\ No newline at end of file
@@ -0,0 +1,22 @@
+import asyncio
+from dotenv import load_dotenv
+
+load_dotenv()
+from database.database import engine, Base
+import models.image  # noqa: F401 — registra la tabla en Base.metadata
+
+
+async def init_db():
+    """Crea las tablas que falten. Una vez por deploy, no en cada worker."""
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+
+async def main():
+    await init_db()
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    # python -m database.initdb
+    asyncio.run(main())
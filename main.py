@@ -1,22 +1,47 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends, Request
-from fastapi.responses import FileResponse, Response
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends, BackgroundTasks, Request, Query
+from fastapi.responses import FileResponse, ORJSONResponse, Response
 from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
 import os
+import asyncio
 import uuid
 import shutil
 import hashlib
-import aiofiles
+import re
+import tempfile
+import time
+from contextlib import asynccontextmanager, suppress
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote
+from cachetools import LRUCache
 from dotenv import load_dotenv
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import FileTarget, ValueTarget
+from streaming_form_data.validators import MaxSizeValidator, ValidationError
 
 load_dotenv()
-from database.database import engine, SessionLocal, Base
+from database.database import engine, SessionLocal, WEB_CONCURRENCY
 from models.image import Image
+from cache import cache
 
-Base.metadata.create_all(bind=engine)
 
-app = FastAPI(title="Image Management API - CRUD Extendido")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Las tablas se crean con `python -m database.initdb`, no en cada worker
+    yield
+    await cache.close()
+    await engine.dispose()
+
+
+app = FastAPI(
+    title="Image Management API - CRUD Extendido",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -32,8 +57,31 @@ app.add_middleware(
 )
 
 BASE_UPLOAD_DIR = "images"
-ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "webp", "jfif", "avif"}
+ALLOWED_EXTENSIONS = frozenset({"png", "jpg", "jpeg", "webp", "jfif", "avif"})
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+MAX_CATEGORY_LENGTH = 255
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+MULTIPART_OVERHEAD = 4096  # boundaries + headers de cada parte
+COPY_BUFFER_SIZE = 1024 * 1024  # 1MB
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Escrituras simultáneas al disco por worker (NVMe ~16-32, HDD ~4)
+MAX_CONCURRENT_WRITES = int(os.getenv("MAX_CONCURRENT_WRITES", "16"))
+# Archivos por request en POST /images/batch
+MAX_BATCH_FILES = int(os.getenv("MAX_BATCH_FILES", "50"))
+
+# Si está definido (ej. "/_protected_images/"), los archivos los entrega nginx
+# vía X-Accel-Redirect y el proceso de Python nunca lee los bytes.
+ACCEL_REDIRECT_PREFIX = os.getenv("ACCEL_REDIRECT_PREFIX")
+
+# Subidas en curso: mismo filesystem que el destino para poder hacer os.replace
+TMP_UPLOAD_DIR = os.path.join(BASE_UPLOAD_DIR, ".tmp")
+
+# Validadores precompilados (corren en cada subida)
+_EXT_RE = re.compile(r"\.([^./\\]+)$")
+# Segmentos de ruta (categoría / nombre): los que empiezan con "." quedan
+# reservados (".", "..", ".tmp")
+_BAD_SEGMENT_RE = re.compile(r"^\.|[/\\\x00]")
 
 # Mapa de extensión → MIME type correcto
 MIME_TYPES = {
@@ -45,73 +93,361 @@ MIME_TYPES = {
     "jfif": "image/jpeg",
 }
 
+# Firmas (magic bytes) → MIME type. 64 bytes alcanzan para la caja ftyp de
+# AVIF con su lista de compatible brands.
+SNIFF_SIZE = 64
+AVIF_BRANDS = frozenset({b"avif", b"avis"})
+
+
+def is_avif(head: bytes) -> bool:
+    """
+    Caja ftyp de ISOBMFF: tamaño (4) + "ftyp" + major brand (4) + minor version (4)
+    + compatible brands (4 c/u). Muchos AVIF válidos usan mif1/msf1 como major
+    brand y declaran avif solo entre los compatibles.
+    """
+    if head[4:8] != b"ftyp":
+        return False
+    box_end = min(int.from_bytes(head[:4], "big"), len(head))
+    brands = {head[8:12]} | {head[i:i + 4] for i in range(16, box_end - 3, 4)}
+    return not AVIF_BRANDS.isdisjoint(brands)
+
+
+def sniff_media_type(head: bytes) -> str | None:
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if is_avif(head):
+        return "image/avif"
+    return None
+
+
+# image_id → (category, filename, media_type). Los nombres llevan UUID, así que
+# una entrada solo queda vieja tras un update/delete; ahí se invalida.
+IMAGE_PATH_CACHE = LRUCache(maxsize=10_000)
+
+# Directorios de categoría ya creados: evita un mkdir(2) con EEXIST por subida.
+# La app nunca borra directorios, así que no hace falta invalidar.
+ENSURED_DIRS: set[str] = set()
+
+WRITE_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENT_WRITES)
+
 os.makedirs(BASE_UPLOAD_DIR, exist_ok=True)
+os.makedirs(TMP_UPLOAD_DIR, exist_ok=True)
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+
+def uuid7() -> uuid.UUID:
+    """
+    UUIDv7 (RFC 9562): timestamp en ms + 74 bits aleatorios. Ordenado por
+    tiempo, así los inserts caen al final del índice único de filename.
+    """
+    value = (time.time_ns() // 1_000_000) << 80 | int.from_bytes(os.urandom(10), "big")
+    value = (value & ~(0xF << 76)) | (0x7 << 76)  # versión 7
+    value = (value & ~(0x3 << 62)) | (0x2 << 62)  # variante RFC
+    return uuid.UUID(int=value)
 
 
 def validate_file_extension(filename: str) -> str:
-    _, ext = os.path.splitext(filename)
-    ext = ext.lower().lstrip(".")
-    if not ext:
+    match = _EXT_RE.search(filename)
+    if not match:
         raise HTTPException(status_code=400, detail="Archivo sin extensión")
+    ext = match.group(1).lower()
     if ext not in ALLOWED_EXTENSIONS:
         raise HTTPException(status_code=400, detail="Extensión no permitida")
     return ext
 
 
 def validate_category(category: str) -> str:
-    safe_category = os.path.normpath(category)
-    if safe_category.startswith("..") or "/" in safe_category or "\\" in safe_category:
+    if not category or _BAD_SEGMENT_RE.search(category):
         raise HTTPException(status_code=400, detail="Categoría inválida")
-    return safe_category
+    return category
+
+
+def validate_content(head: bytes, ext: str) -> None:
+    """El contenido real (magic bytes) debe coincidir con la extensión declarada."""
+    sniffed = sniff_media_type(head)
+    if sniffed is None:
+        raise HTTPException(status_code=400, detail="El archivo no es una imagen soportada")
+    if sniffed != MIME_TYPES.get(ext):
+        raise HTTPException(status_code=400, detail="La extensión no coincide con el contenido")
+
+
+def validate_new_filename(filename: str) -> str:
+    """Nombre nuevo para un rename: devuelve la base sin extensión."""
+    new_base, _ = os.path.splitext(filename)
+    if not new_base or _BAD_SEGMENT_RE.search(new_base):
+        raise HTTPException(status_code=400, detail="Nombre de archivo inválido")
+    return new_base
+
+
+def media_type_for(filename: str) -> str:
+    return MIME_TYPES.get(filename.rpartition(".")[2].lower(), "application/octet-stream")
+
+
+async def resolve_image_path(image_id: int, db: AsyncSession) -> tuple[str, str, str]:
+    """
+    Devuelve (category, filename, media_type) desde el caché LRU del proceso,
+    luego Redis y por último la BD. El MIME type se resuelve una sola vez.
+    """
+    cached = IMAGE_PATH_CACHE.get(image_id)
+    if cached:
+        return cached
+
+    cached = await cache.get_path(image_id)
+    if cached:
+        IMAGE_PATH_CACHE[image_id] = cached
+        return cached
+
+    row = (await db.execute(
+        select(Image.category, Image.filename).where(Image.id == image_id)
+    )).first()
+    if not row:
+        raise HTTPException(status_code=404, detail="Imagen no encontrada")
+
+    entry = (row.category, row.filename, media_type_for(row.filename))
+    IMAGE_PATH_CACHE[image_id] = entry
+    await cache.set_path(image_id, entry)
+    return entry
+
+
+async def forget_image_path(image_id: int) -> None:
+    IMAGE_PATH_CACHE.pop(image_id, None)
+    await cache.delete_path(image_id)
+
+
+async def run_disk_write(func, *args):
+    """
+    Corre una escritura bloqueante en el threadpool, limitada por
+    WRITE_SEMAPHORE para no saturar la cola del dispositivo.
+    """
+    async with WRITE_SEMAPHORE:
+        return await run_in_threadpool(func, *args)
+
+
+def ensure_dir(path: str) -> None:
+    if path not in ENSURED_DIRS:
+        os.makedirs(path, exist_ok=True)
+        ENSURED_DIRS.add(path)
+
+
+def check_content_length(request: Request) -> None:
+    """
+    Rechaza con 413 usando Content-Length, sin tocar el body. Solo sirve en
+    handlers que leen el stream ellos mismos (upload_image): con UploadFile el
+    form ya fue parseado antes del handler. Un body chunked no trae el header;
+    ahí el límite lo aplica LimitedFileTarget.
+    """
+    try:
+        declared = int(request.headers.get("content-length", "0"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Content-Length inválido")
+    if declared > MAX_FILE_SIZE + MULTIPART_OVERHEAD:
+        raise HTTPException(status_code=413, detail="Archivo muy grande")
+
 
+class FileTooLarge(Exception):
+    pass
 
-def build_etag(path: str) -> str:
+
+class DuplicatePart(Exception):
+    pass
+
+
+class LimitedFileTarget(FileTarget):
+    """
+    FileTarget que escribe directo al disco y aborta al superar `max_size`.
+    Guarda los primeros bytes en `head` para validar el tipo real.
+    `finished` solo queda en True si la parte llegó completa (boundary de cierre).
+    Un segundo campo `file` se rechaza con DuplicatePart: FileTarget reabriría el
+    archivo con "wb" y se guardaría una parte que nunca pasó por la validación.
+    El archivo parcial se elimina con `discard()`.
+    """
+
+    def __init__(self, filename: str, max_size: int):
+        super().__init__(filename)
+        self.max_size = max_size
+        self.size = 0
+        self.head = b""
+        self.opened = False
+        self.finished = False
+
+    def on_start(self):
+        if self.opened:
+            raise DuplicatePart()
+        self.opened = True
+        super().on_start()
+
+    def on_data_received(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise FileTooLarge()
+        if len(self.head) < SNIFF_SIZE:
+            self.head += chunk[:SNIFF_SIZE - len(self.head)]
+        super().on_data_received(chunk)
+
+    def on_finish(self):
+        super().on_finish()
+        self.finished = True
+
+    def discard(self):
+        if self._fd and not self._fd.closed:
+            self._fd.close()
+        with suppress(FileNotFoundError):
+            os.remove(self.filename)
+
+
+class SingleValueTarget(ValueTarget):
+    """
+    ValueTarget que rechaza un campo repetido en vez de concatenar los valores.
+    `finished` igual que en LimitedFileTarget.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.opened = False
+        self.finished = False
+
+    def on_start(self):
+        if self.opened:
+            raise DuplicatePart()
+        self.opened = True
+
+    def on_finish(self):
+        self.finished = True
+
+
+def copy_upload(src, dst_path: str) -> None:
+    """
+    Copia el contenido de un UploadFile (`file.file`) a `dst_path`.
+    Si el SpooledTemporaryFile ya pasó a disco la copia queda en el kernel:
+    os.copy_file_range (en el mismo filesystem puede ni copiar bloques) y, si
+    el kernel/FS no lo soporta, os.sendfile. Si sigue en memoria, copyfileobj
+    con buffer de 1MB.
+    """
+    src.seek(0)
+    with open(dst_path, "wb", buffering=COPY_BUFFER_SIZE) as dst:
+        if isinstance(src, tempfile.SpooledTemporaryFile) and src._rolled:
+            src_fd, dst_fd = src.fileno(), dst.fileno()
+            offset = 0
+            if hasattr(os, "copy_file_range"):
+                try:
+                    while copied := os.copy_file_range(src_fd, dst_fd, MAX_FILE_SIZE, offset):
+                        offset += copied
+                except OSError:
+                    # EXDEV/EINVAL/ENOSYS: seguir con sendfile desde donde quedó
+                    pass
+            while sent := os.sendfile(dst_fd, src_fd, offset, COPY_BUFFER_SIZE):
+                offset += sent
+        else:
+            shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+
+
+def write_upload(src, path: str) -> None:
+    """
+    Escribe un UploadFile en `path`. Se escribe aparte y se reemplaza con
+    os.replace (atómico): un GET concurrente nunca ve el archivo a medio escribir.
+    """
+    tmp_path = os.path.join(TMP_UPLOAD_DIR, f"{uuid.uuid4()}.part")
+    try:
+        copy_upload(src, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+
+def remove_files(paths) -> None:
+    for path in paths:
+        with suppress(FileNotFoundError):
+            os.remove(path)
+
+
+def apply_file_update(src, old_path: str, new_path: str) -> None:
+    """Cambios en disco de update_image. Bloqueante: se corre en el threadpool."""
+    ensure_dir(os.path.dirname(new_path))
+
+    if src:
+        write_upload(src, new_path)
+        if new_path != old_path:
+            with suppress(FileNotFoundError):
+                os.remove(old_path)
+    elif new_path != old_path:
+        # Todo vive bajo BASE_UPLOAD_DIR (mismo filesystem): un solo rename(2).
+        # Si el archivo ya no está, solo se actualiza la BD (como antes).
+        with suppress(FileNotFoundError):
+            os.replace(old_path, new_path)
+
+
+def build_etag(stat: os.stat_result) -> str:
     """ETag basado en tamaño + fecha de modificación (sin leer el archivo)."""
-    stat = os.stat(path)
     raw = f"{stat.st_size}-{stat.st_mtime}"
     return hashlib.md5(raw.encode()).hexdigest()
 
 
-def serve_image(path: str, filename: str, request: Request) -> Response:
+def is_not_modified(request: Request, etag: str, mtime: int) -> bool:
+    """
+    Valida If-None-Match y, solo si no vino, If-Modified-Since (RFC 9110 §13.2.2).
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+        return "*" in tags or f'"{etag}"' in tags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return mtime <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def serve_image(path: str, filename: str, media_type: str, request: Request) -> Response:
     """
     Sirve un archivo de imagen con headers de caché correctos.
     - Cache-Control: 1 año para assets inmutables (el nombre incluye UUID).
     - ETag + Last-Modified para validación condicional.
     - Responde 304 Not Modified si el cliente ya tiene la versión actual.
     """
-    if not os.path.exists(path):
+    # Un solo stat(2): si no existe, FileNotFoundError en vez de exists() + stat()
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Archivo no encontrado")
+    etag = build_etag(stat)
+    last_modified = int(stat.st_mtime)
 
-    stat = os.stat(path)
-    etag = build_etag(path)
-    last_modified = stat.st_mtime
-
-    # Validación condicional — el cliente ya tiene la imagen
-    if_none_match = request.headers.get("if-none-match")
-    if if_none_match and if_none_match == f'"{etag}"':
-        return Response(status_code=304)
-
-    _, ext = os.path.splitext(filename)
-    ext_clean = ext.lower().lstrip(".")
-    media_type = MIME_TYPES.get(ext_clean, "application/octet-stream")
+    # Validación condicional — el cliente ya tiene la imagen: 304 sin abrir el archivo
+    if is_not_modified(request, etag, last_modified):
+        return Response(
+            status_code=304,
+            headers={"ETag": f'"{etag}"', "Cache-Control": CACHE_CONTROL},
+        )
 
     # 1 año de caché — válido porque el filename incluye UUID (cambia si se reemplaza)
-    response = FileResponse(
-        path,
-        media_type=media_type,
-        filename=filename,
-    )
-    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    if ACCEL_REDIRECT_PREFIX:
+        rel_path = os.path.relpath(path, BASE_UPLOAD_DIR).replace(os.sep, "/")
+        response = Response(media_type=media_type)
+        response.headers["X-Accel-Redirect"] = ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + quote(rel_path)
+        response.headers["Content-Disposition"] = f'attachment; filename="{quote(filename)}"'
+    else:
+        response = FileResponse(
+            path,
+            media_type=media_type,
+            filename=filename,
+            stat_result=stat,
+        )
+    response.headers["Cache-Control"] = CACHE_CONTROL
     response.headers["ETag"] = f'"{etag}"'
-    response.headers["Last-Modified"] = str(int(last_modified))
+    response.headers["Last-Modified"] = formatdate(last_modified, usegmt=True)
     response.headers["Vary"] = "Accept-Encoding"
 
     return response
@@ -121,102 +457,324 @@ def serve_image(path: str, filename: str, request: Request) -> Response:
 # Endpoints (sin cambios en firma)
 # -------------------------
 
-@app.post("/images", status_code=201)
-async def upload_image(
-    category: str = Form(...),
-    file: UploadFile = File(...),
-    db: Session = Depends(get_db)
-):
-    safe_category = validate_category(category)
-    ext = validate_file_extension(file.filename)
+UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["category", "file"],
+                    "properties": {
+                        "category": {"type": "string"},
+                        "file": {"type": "string", "format": "binary"},
+                    },
+                }
+            }
+        },
+    }
+}
+
 
-    file.file.seek(0, 2)
-    file_size = file.file.tell()
-    file.file.seek(0)
+@app.post("/images", status_code=201, openapi_extra=UPLOAD_OPENAPI)
+async def upload_image(request: Request, db: AsyncSession = Depends(get_db)):
+    """
+    Sube una imagen leyendo el multipart directamente de `request.stream()`.
+    El archivo se escribe al disco a medida que llega (fuera del event loop),
+    sin pasar por el SpooledTemporaryFile de Starlette, y luego se mueve a su
+    categoría.
+    """
+    check_content_length(request)
+
+    tmp_path = os.path.join(TMP_UPLOAD_DIR, f"{uuid.uuid4()}.part")
+    file_target = LimitedFileTarget(tmp_path, MAX_FILE_SIZE)
+    category_target = SingleValueTarget(validator=MaxSizeValidator(MAX_CATEGORY_LENGTH))
 
-    if file_size > MAX_FILE_SIZE:
+    try:
+        parser = StreamingFormDataParser(headers=request.headers)
+        parser.register("file", file_target)
+        parser.register("category", category_target)
+        # El parser escribe al disco de forma síncrona: se le pasan bloques de
+        # ~1MB en el threadpool para no bloquear el event loop con cada write.
+        # El semáforo se toma por bloque, no mientras se espera a la red.
+        pending: list[bytes] = []
+        pending_size = 0
+        async for chunk in request.stream():
+            pending.append(chunk)
+            pending_size += len(chunk)
+            if pending_size >= COPY_BUFFER_SIZE:
+                await run_disk_write(parser.data_received, b"".join(pending))
+                pending.clear()
+                pending_size = 0
+        if pending:
+            await run_disk_write(parser.data_received, b"".join(pending))
+    except FileTooLarge:
+        file_target.discard()
         raise HTTPException(status_code=413, detail="Archivo muy grande")
+    except DuplicatePart:
+        file_target.discard()
+        raise HTTPException(status_code=400, detail="Campo repetido en el formulario")
+    except ValidationError:
+        file_target.discard()
+        raise HTTPException(status_code=400, detail="Categoría inválida")
+    except ParseFailedException:
+        file_target.discard()
+        raise HTTPException(status_code=400, detail="Formulario multipart inválido")
+    except Exception as e:
+        file_target.discard()
+        raise HTTPException(status_code=500, detail=str(e))
+    except BaseException:
+        # Request cancelado: no dejar el .part en TMP_UPLOAD_DIR
+        file_target.discard()
+        raise
 
-    filename = f"{uuid.uuid4()}.{ext}"
+    try:
+        if not file_target.multipart_filename:
+            raise HTTPException(status_code=422, detail="Falta el campo 'file'")
+        if not category_target.value:
+            raise HTTPException(status_code=422, detail="Falta el campo 'category'")
+        # Body cortado (sin boundary de cierre): el parser no falla, pero las
+        # partes nunca terminan y el archivo quedaría truncado
+        if not (file_target.finished and category_target.finished):
+            raise HTTPException(status_code=400, detail="Formulario multipart inválido")
+        safe_category = validate_category(category_target.value.decode("utf-8", "replace"))
+        ext = validate_file_extension(file_target.multipart_filename)
+        validate_content(file_target.head, ext)
+    except HTTPException:
+        file_target.discard()
+        raise
+
+    filename = f"{uuid7().hex}.{ext}"
     category_dir = os.path.join(BASE_UPLOAD_DIR, safe_category)
-    os.makedirs(category_dir, exist_ok=True)
+    ensure_dir(category_dir)
     file_path = os.path.join(category_dir, filename)
 
     try:
-        async with aiofiles.open(file_path, "wb") as f:
-            while chunk := await file.read(1024 * 64):
-                await f.write(chunk)
+        os.replace(tmp_path, file_path)
     except Exception as e:
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        file_target.discard()
         raise HTTPException(status_code=500, detail=str(e))
 
     try:
-        image = Image(filename=filename, category=safe_category)
-        db.add(image)
-        db.commit()
-        db.refresh(image)
+        # INSERT ... RETURNING: el id llega en el mismo round-trip, sin refresh
+        image_id = (await db.execute(
+            insert(Image).values(filename=filename, category=safe_category).returning(Image.id)
+        )).scalar_one()
+        await db.commit()
     except Exception as e:
-        if os.path.exists(file_path):
+        with suppress(FileNotFoundError):
             os.remove(file_path)
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
+    except BaseException:
+        # Cancelado durante el INSERT: la sesión hace rollback al cerrarse
+        with suppress(FileNotFoundError):
+            os.remove(file_path)
+        raise
+
+    await cache.invalidate_listing()
 
     return {
-        "id": image.id,
-        "filename": image.filename,
-        "category": image.category,
-        "url": f"/images/{image.id}"
+        "id": image_id,
+        "filename": filename,
+        "category": safe_category,
+        "url": f"/images/{image_id}",
+        "file_url": f"/images/{quote(safe_category)}/{filename}"
+    }
+
+
+@app.post("/images/batch", status_code=201)
+async def upload_images_batch(
+    files: list[UploadFile] = File(...),
+    category: str = Form(...),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Sube varias imágenes a una misma categoría en un solo request. Los archivos
+    se escriben en paralelo (acotado por WRITE_SEMAPHORE) y las filas se crean
+    con un único INSERT ... RETURNING y un solo commit, en vez de uno por imagen.
+    """
+    if len(files) > MAX_BATCH_FILES:
+        raise HTTPException(status_code=400, detail=f"Máximo {MAX_BATCH_FILES} archivos por request")
+
+    safe_category = validate_category(category)
+
+    rows = []
+    for file in files:
+        if file.size is None or file.size > MAX_FILE_SIZE:
+            raise HTTPException(status_code=413, detail="Archivo muy grande")
+        ext = validate_file_extension(file.filename or "")
+        validate_content(await file.read(SNIFF_SIZE), ext)
+        rows.append({"filename": f"{uuid7().hex}.{ext}", "category": safe_category})
+
+    category_dir = os.path.join(BASE_UPLOAD_DIR, safe_category)
+    ensure_dir(category_dir)
+    paths = [os.path.join(category_dir, row["filename"]) for row in rows]
+
+    # return_exceptions: esperar a que terminen todas antes de limpiar
+    try:
+        results = await asyncio.gather(
+            *(run_disk_write(write_upload, file.file, path) for file, path in zip(files, paths)),
+            return_exceptions=True,
+        )
+    except BaseException:
+        # Request cancelado: no dejar archivos huérfanos en la categoría
+        remove_files(paths)
+        raise
+    errors = [r for r in results if isinstance(r, BaseException)]
+    if errors:
+        remove_files(paths)
+        raise HTTPException(status_code=500, detail=str(errors[0]))
+
+    try:
+        created = (await db.execute(
+            insert(Image).returning(
+                Image.id, Image.filename, Image.category, sort_by_parameter_order=True
+            ),
+            rows,
+        )).all()
+        await db.commit()
+    except Exception as e:
+        remove_files(paths)
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    except BaseException:
+        # Cancelado durante el INSERT: la sesión hace rollback al cerrarse
+        remove_files(paths)
+        raise
+
+    await cache.invalidate_listing()
+
+    return [
+        {
+            "id": image.id,
+            "filename": image.filename,
+            "category": image.category,
+            "url": f"/images/{image.id}",
+            "file_url": f"/images/{quote(image.category)}/{image.filename}"
+        }
+        for image in created
+    ]
+
+
+async def update_image_metadata(
+    image_id: int,
+    filename: str | None,
+    category: str | None,
+    db: AsyncSession,
+) -> dict:
+    """
+    Renombrar / mover sin archivo nuevo: un solo UPDATE ... RETURNING en vez de
+    SELECT + UPDATE. El CTE bloquea la fila y devuelve también los valores
+    anteriores, necesarios para mover el archivo en disco.
+    """
+    old = (
+        select(Image.id, Image.filename, Image.category)
+        .where(Image.id == image_id)
+        .with_for_update()
+        .cte("old")
+    )
+    changes = {}
+    if filename:
+        # Conserva la extensión original: new_base + extensión del nombre anterior
+        new_base = validate_new_filename(filename)
+        changes["filename"] = func.concat(new_base, func.substring(old.c.filename, r"\.[^.]*$"))
+    if category:
+        changes["category"] = validate_category(category)
+
+    stmt = (
+        update(Image)
+        .where(Image.id == old.c.id)
+        .values(**changes)
+        .returning(
+            Image.id,
+            Image.filename,
+            Image.category,
+            old.c.filename.label("old_filename"),
+            old.c.category.label("old_category"),
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+    try:
+        row = (await db.execute(stmt)).first()
+        if not row:
+            raise HTTPException(status_code=404, detail="Imagen no encontrada")
+
+        old_path = os.path.join(BASE_UPLOAD_DIR, row.old_category, row.old_filename)
+        new_path = os.path.join(BASE_UPLOAD_DIR, row.category, row.filename)
+        await run_disk_write(apply_file_update, None, old_path, new_path)
+
+        await db.commit()
+        await forget_image_path(image_id)
+        await cache.invalidate_listing()
+
+    except HTTPException:
+        await db.rollback()
+        raise
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return {
+        "detail": "Imagen actualizada",
+        "id": row.id,
+        "filename": row.filename,
+        "category": row.category,
+        "file_replaced": False
     }
 
 
 @app.patch("/images/{image_id}")
-def update_image(
+async def update_image(
     image_id: int,
     file: UploadFile | None = File(None),
     filename: str | None = Form(None),
     category: str | None = Form(None),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    image = db.query(Image).filter(Image.id == image_id).first()
-    if not image:
-        raise HTTPException(status_code=404, detail="Imagen no encontrada")
-
     if not any([file, filename, category]):
         raise HTTPException(status_code=400, detail="No se enviaron campos para actualizar")
 
+    if not file:
+        return await update_image_metadata(image_id, filename, category, db)
+
+    # Starlette ya spooleó el form completo: el límite se valida sobre el tamaño real
+    if file.size is None or file.size > MAX_FILE_SIZE:
+        raise HTTPException(status_code=413, detail="Archivo muy grande")
+
+    image = await db.get(Image, image_id)
+    if not image:
+        raise HTTPException(status_code=404, detail="Imagen no encontrada")
+
     old_filename = image.filename
     old_category = image.category
 
     if filename:
         _, old_ext = os.path.splitext(old_filename)
-        new_base, _ = os.path.splitext(filename)
-        final_filename = f"{new_base}{old_ext}"
+        final_filename = f"{validate_new_filename(filename)}{old_ext}"
     else:
         final_filename = old_filename
 
-    final_category = category if category else old_category
+    final_category = validate_category(category) if category else old_category
+
+    # El archivo nuevo conserva la extensión: su contenido tiene que coincidir
+    validate_content(await file.read(SNIFF_SIZE), old_filename.rpartition(".")[2].lower())
 
     old_path = os.path.join(BASE_UPLOAD_DIR, old_category, old_filename)
     new_path = os.path.join(BASE_UPLOAD_DIR, final_category, final_filename)
 
     try:
-        os.makedirs(os.path.join(BASE_UPLOAD_DIR, final_category), exist_ok=True)
-
-        if file:
-            with open(new_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            if new_path != old_path and os.path.exists(old_path):
-                os.remove(old_path)
-        elif new_path != old_path and os.path.exists(old_path):
-            shutil.move(old_path, new_path)
+        await run_disk_write(apply_file_update, file.file, old_path, new_path)
 
         image.filename = final_filename
         image.category = final_category
-        db.commit()
+        await db.commit()
+        await forget_image_path(image_id)
+        await cache.invalidate_listing()
 
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
     return {
@@ -224,28 +782,59 @@ def update_image(
         "id": image.id,
         "filename": image.filename,
         "category": image.category,
-        "file_replaced": bool(file)
+        "file_replaced": True
     }
 
 
 @app.get("/images")
-def get_all_images(db: Session = Depends(get_db)):
-    images = db.query(Image).all()
-    return [
-        {
-            "id": i.id,
-            "filename": i.filename,
-            "category": i.category,
-            "created_at": i.created_at,
-            "url": f"/images/{i.id}"
-        }
-        for i in images
-    ]
+async def get_all_images(
+    after_id: int | None = None,
+    category: str | None = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Listado paginado por cursor (keyset): `WHERE id > after_id ORDER BY id`.
+    El costo por página no depende del tamaño de la tabla. Para la siguiente
+    página se envía `after_id=next_cursor`; `next_cursor` es null al final.
+    Con `category` usa el índice (category, id).
+    Las páginas se cachean en Redis unos segundos y se invalidan en cada cambio.
+    """
+    # Ausencia explícita: sin filtro y ?category=None no deben compartir página
+    page_key = f"{after_id}|{limit}|" + ("" if category is None else "c:" + category)
+    cached = await cache.get_listing(page_key)
+    if cached:
+        return Response(content=cached, media_type="application/json")
+
+    # Solo las columnas del listado: filas livianas, sin objetos ORM ni identity map
+    stmt = select(Image.id, Image.filename, Image.category, Image.created_at).order_by(Image.id)
+    if category is not None:
+        stmt = stmt.where(Image.category == category)
+    if after_id is not None:
+        stmt = stmt.where(Image.id > after_id)
+    rows = (await db.execute(stmt.limit(limit + 1))).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    page = {
+        "items": [
+            {
+                "id": r.id,
+                "filename": r.filename,
+                "category": r.category,
+                "created_at": r.created_at,
+                "url": f"/images/{r.id}"
+            }
+            for r in rows
+        ],
+        "next_cursor": rows[-1].id if has_more else None,
+    }
+    return Response(content=await cache.set_listing(page_key, page), media_type="application/json")
 
 
 @app.get("/images/{image_id}")
-def get_image_by_id(image_id: int, db: Session = Depends(get_db)):
-    image = db.query(Image).filter(Image.id == image_id).first()
+async def get_image_by_id(image_id: int, db: AsyncSession = Depends(get_db)):
+    image = await db.get(Image, image_id)
     if not image:
         raise HTTPException(status_code=404, detail="Imagen no encontrada")
     return {
@@ -258,30 +847,80 @@ def get_image_by_id(image_id: int, db: Session = Depends(get_db)):
 
 
 @app.get("/images/{image_id}/file")
-def get_image_file(image_id: int, request: Request, db: Session = Depends(get_db)):
-    image = db.query(Image).filter(Image.id == image_id).first()
-    if not image:
-        raise HTTPException(status_code=404, detail="Imagen no encontrada")
+async def get_image_file(image_id: int, request: Request, db: AsyncSession = Depends(get_db)):
+    category, filename, media_type = await resolve_image_path(image_id, db)
+    path = os.path.join(BASE_UPLOAD_DIR, category, filename)
+
+    try:
+        return serve_image(path, filename, media_type, request)
+    except HTTPException as e:
+        if e.status_code != 404:
+            raise
 
-    path = os.path.join(BASE_UPLOAD_DIR, image.category, image.filename)
-    return serve_image(path, image.filename, request)
+    # La entrada pudo quedar vieja si otro worker movió la imagen: volver a la BD
+    await forget_image_path(image_id)
+    category, filename, media_type = await resolve_image_path(image_id, db)
+    path = os.path.join(BASE_UPLOAD_DIR, category, filename)
+    return serve_image(path, filename, media_type, request)
+
+
+@app.get("/images/{category}/{filename}")
+async def get_image_file_by_path(category: str, filename: str, request: Request):
+    """
+    Sirve el archivo directo desde la URL devuelta por la subida
+    (`/images/{category}/{filename}`), sin consultar la BD ni el caché.
+    """
+    safe_category = validate_category(category)
+    ext = filename.rpartition(".")[2].lower()
+    if _BAD_SEGMENT_RE.search(filename) or ext not in ALLOWED_EXTENSIONS:
+        raise HTTPException(status_code=404, detail="Archivo no encontrado")
+
+    path = os.path.join(BASE_UPLOAD_DIR, safe_category, filename)
+    return serve_image(path, filename, MIME_TYPES[ext], request)
 
 
 @app.delete("/images/{image_id}", status_code=200)
-def delete_image_by_id(image_id: int, db: Session = Depends(get_db)):
-    image = db.query(Image).filter(Image.id == image_id).first()
-    if not image:
+async def delete_image_by_id(
+    image_id: int,
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_db)
+):
+    # Un solo DELETE ... RETURNING: sin SELECT previo ni objeto ORM
+    row = (await db.execute(
+        delete(Image).where(Image.id == image_id).returning(Image.category, Image.filename)
+    )).first()
+    if not row:
+        await db.rollback()
         raise HTTPException(status_code=404, detail="Imagen no encontrada")
 
-    path = os.path.join(BASE_UPLOAD_DIR, image.category, image.filename)
+    path = os.path.join(BASE_UPLOAD_DIR, row.category, row.filename)
 
     try:
-        if os.path.exists(path):
-            os.remove(path)
-        db.delete(image)
-        db.commit()
+        await db.commit()
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Error eliminando imagen")
 
-    return {"detail": "Imagen eliminada"}
\ No newline at end of file
+    await forget_image_path(image_id)
+    await cache.invalidate_listing()
+    # La BD es la fuente de verdad: el archivo se borra después de responder.
+    # Si el proceso muere antes, queda un archivo huérfano, no una fila sin archivo.
+    background_tasks.add_task(remove_files, [path])
+
+    return {"detail": "Imagen eliminada"}
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # Producción: uvloop + httptools. No se usa os.cpu_count(): en un contenedor
+    # devuelve los núcleos del host. Cada worker abre su propio pool, dimensionado
+    # en database.py para que WEB_CONCURRENCY workers no pasen DB_MAX_CONNECTIONS.
+    uvicorn.run(
+        "main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        workers=WEB_CONCURRENCY,
+        loop="uvloop",
+        http="httptools",
+        limit_concurrency=int(os.getenv("LIMIT_CONCURRENCY", "512")),
+    )
\ No newline at end of file
@@ -1,10 +1,18 @@
-from sqlalchemy import Column, Integer, String, DateTime, func
+from sqlalchemy import Column, Integer, String, DateTime, Index, func
 from database.database import Base
 
 class Image(Base):
     __tablename__ = "images"
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
+    # unique=True ya crea el índice B-tree sobre filename
     filename = Column(String, nullable=False, unique=True)
-    category = Column(String, nullable=False, index=True)
-    created_at = Column(DateTime, server_default=func.now())
\ No newline at end of file
+    category = Column(String, nullable=False)
+    created_at = Column(DateTime, server_default=func.now())
+
+    __table_args__ = (
+        # Cubre filtros por categoría y el listado paginado por categoría (keyset sobre id)
+        Index("ix_images_category_id", "category", "id"),
+        # Lookup id → (category, filename) al servir archivos: index-only scan
+        Index("ix_images_id_incl_path", "id", postgresql_include=["category", "filename"]),
+    )
\ No newline at end of file